@@ -7,6 +7,10 @@ Original file is located at
     https://colab.research.google.com/drive/1xJa8csPpnuRuv7bqOex8fZCV8A4bP16C
 """
 
+# python-chess lets the explorer derive child FENs without the engine
+import os
+os.system('pip install -q chess')
+
 # Leaf Sorting Tree Explorer
 import os
 import subprocess
@@ -24,6 +28,13 @@ MULTIPV = 10
 DEPTH = 13
 THRESHOLD = 100
 
+# Child positions are computed locally when python-chess knows the variant
+try:
+    import chess.variant
+    BOARD = next((board for board in chess.variant.VARIANTS if board.uci_variant == VARIANT), None)
+except ImportError:
+    BOARD = None
+
 # Colab setup
 from google.colab import drive
 drive.mount('/content/drive/')
@@ -261,7 +272,7 @@ class Tree:
                         score = 30000 - 2 * score
                     elif score < 0:
                         score = -30001 + 2 * score
-            child_fen = self.engine.get_fen(f'position fen {self.fen[position_idx]} moves {move}')
+            child_fen = self.child_fen(self.fen[position_idx], move)
             child_key = f'{move}|{child_fen}'
             if child_key in self.fen_to_index:
                 child_idx = self.fen_to_index[child_key]
@@ -279,6 +290,16 @@ class Tree:
             if alt == 1:
                 break
 
+    def child_fen(self, fen: str, move: str) -> str:
+        if BOARD:
+            try:
+                board = BOARD(fen)
+                board.push_uci(move)
+                return board.fen()
+            except ValueError:
+                pass
+        return self.engine.get_fen(f'position fen {fen} moves {move}')
+
     def analyze(self):
         self.cycle_count += 1
         side = 'White' if self.analyzing_white else 'Black'
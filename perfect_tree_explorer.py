@@ -16,6 +16,14 @@ THREADS      = 4            #@param {type:"integer"}
 HASHMB       = 4096         #@param {type:"integer"}
 DEPTH        = 30           #@param {type:"integer"}
 
+# Child positions are computed locally when python-chess knows the variant
+os.system('pip install -q chess')
+try:
+    import chess.variant
+    BOARD = next((board for board in chess.variant.VARIANTS if board.uci_variant == VARIANT), None)
+except ImportError:
+    BOARD = None
+
 from google.colab import drive
 drive.mount('/content/drive/')
 
@@ -363,7 +371,7 @@ class Tree:
         move = node['moves'][move_idx]
         move_eval = node['evals'][move_idx]
 
-        child_fen = self.engine.get_fen(f"position fen {fen} moves {move}")
+        child_fen = self.child_fen(fen, move)
 
         if child_fen in self.fen_to_id:
             child_id = self.fen_to_id[child_fen]
@@ -380,6 +388,17 @@ class Tree:
 
         return child_id
 
+    def child_fen(self, fen: str, move: str) -> str:
+        if BOARD:
+            try:
+                board = BOARD(fen)
+                board.push_uci(move)
+                # Keep the same board + side-to-move key that get_fen returns
+                return ' '.join(board.fen().split()[:2])
+            except ValueError:
+                pass
+        return self.engine.get_fen(f"position fen {fen} moves {move}")
+
     def backpropagate_evals(self):
         last_changed = [0] * self.node_count
         iteration = 0
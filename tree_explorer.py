@@ -1,10 +1,30 @@
 #!/usr/bin/env python3
 import platform
 import argparse
+import functools
+import hashlib
+import heapq
+import queue
+import re
+from array import array
+import io
+import mmap
+import os
+import struct
 import subprocess
-import time
+import sys
+import threading
+from itertools import accumulate
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import chess
+    import chess.polyglot
+    import chess.variant
+except ImportError:
+    chess = None
 
 VARIANT = 'chess'
 ENGINE = 'stockfish.exe' if platform.system() == 'Windows' else 'stockfish'
@@ -12,56 +32,165 @@ THREADS = 4
 HASH = 8192
 MULTIPV = 6
 DEPTH = 24
+WORKERS = 1
+COMPACT = 10000
+
+MAGIC = b"FSTREE\x00\x01"
+# idx, score, best, length, fen bytes, move bytes, children
+RECORD = struct.Struct('<iiiiHBH')
+SNAPSHOT = b"FSTREE\x00\x02"
+# nodes, child values, fen bytes, move bytes, zobrist keys; the columns
+# follow in native byte order
+HEADER = struct.Struct('<qqqq?')
+INFO = re.compile(r"info depth (?P<depth>\d+) .*?\bmultipv (?P<multipv>\d+) score (?P<type>cp|mate) (?P<score>-?\d+)"
+                  r"(?P<bound> lowerbound| upperbound)? .*?\bpv (?P<move>\S+)")
+
+def zobrist_keys() -> bool:
+    return chess is not None and VARIANT == "chess"
+
+def position_key(fen: str) -> int:
+    if zobrist_keys():
+        try:
+            return chess.polyglot.zobrist_hash(chess.Board(fen))
+        except ValueError:
+            pass
+    digest = hashlib.blake2b(fen.rsplit(' ', 2)[0].encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def challenger(score: int, length: int) -> int:
+    # How attractive a child is from its parent's side: prefer quick wins
+    # and slow losses
+    return -score + length if score < 0 else -score - length
+
+def write_text(path: Path, fens: List[str], moves: List[Optional[str]], score: array, best: array,
+               length: array, child_start: array, child_count: array, child_values: array):
+    temp_path = Path(f"{path}.tmp")
+    with open(temp_path, 'w', buffering=1 << 20) as f:
+        f.write("% idx|move|score|best|length; fen; children;\n")
+        for idx, fen in enumerate(fens):
+            start = child_start[idx]
+            children = ','.join(map(str, child_values[start:start + child_count[idx]]))
+            f.write(f"{idx}|{moves[idx] or 'None'}|{score[idx]}|{best[idx] if best[idx] >= 0 else 'None'}|"
+                    f"{length[idx]}; {fen}; {children};\n")
+    os.replace(temp_path, path)
+
+def variant_board():
+    if chess:
+        for board in chess.variant.VARIANTS:
+            if board.uci_variant == VARIANT:
+                return board
+    return None
+
+@functools.lru_cache(maxsize=None)
+def engine_files(variant: str) -> Tuple[bool, Optional[Path]]:
+    return Path('variants.ini').exists(), next(Path(variant).glob('*.nnue'), None)
+
+def same_position(fen: str, other: str) -> bool:
+    return fen.rsplit(' ', 2)[0] == other.rsplit(' ', 2)[0]
 
 class Engine:
-    def __init__(self):
+    def __init__(self, threads: int, hash_mb: int):
         self.process = subprocess.Popen(
             [ENGINE],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=0
+            bufsize=1 << 16
         )
+        self.stdin = io.TextIOWrapper(self.process.stdin, encoding='ascii', errors='replace')
+        self.stdout = io.TextIOWrapper(self.process.stdout, encoding='ascii', errors='replace')
+        self.lines = queue.SimpleQueue()
+        threading.Thread(target=self.read_output, daemon=True).start()
         self.send("uci")
         self.receive("uciok")
-        if Path('variants.ini').exists():
-            self.send("load variants.ini")
-        self.send(f"setoption name UCI_Variant value {VARIANT}")
-        NNUE = next(Path(VARIANT).glob('*.nnue'), None)
+        variants_ini, NNUE = engine_files(VARIANT)
+        if variants_ini:
+            self.send("load variants.ini", flush=False)
+        self.send(f"setoption name UCI_Variant value {VARIANT}", flush=False)
         if NNUE:
-            self.send(f"setoption name EvalFile value {NNUE}")
-            self.send("setoption name Use NNUE value true")
+            self.send(f"setoption name EvalFile value {NNUE}", flush=False)
+            self.send("setoption name Use NNUE value true", flush=False)
         else:
-            self.send("setoption name Use NNUE value false")
-        self.send(f"setoption name Threads value {THREADS}")
-        self.send(f"setoption name Hash value {HASH}")
+            self.send("setoption name Use NNUE value false", flush=False)
+        self.send(f"setoption name Threads value {threads}", flush=False)
+        self.send(f"setoption name Hash value {hash_mb}", flush=False)
         self.send(f"setoption name MultiPV value {MULTIPV}")
 
-    def send(self, command: str):
+    def send(self, command: str, flush: bool = True):
         if self.process.poll() is None:
-            self.process.stdin.write(f"{command}\n")
-            self.process.stdin.flush()
+            self.stdin.write(f"{command}\n")
+            if flush:
+                self.stdin.flush()
 
-    def receive(self, terminator: str) -> List[str]:
-        lines = []
+    def flush(self):
+        if self.process.poll() is None:
+            self.stdin.flush()
+
+    def position(self, fen: str, moves: Tuple[str, ...] = (), flush: bool = True):
+        command = f"position fen {fen}"
+        if moves:
+            command += f" moves {' '.join(moves)}"
+        self.send(command, flush)
+
+    def read_output(self):
+        for line in self.stdout:
+            self.lines.put(line.strip())
+        self.lines.put(None)
+
+    def stream(self, terminator: str) -> Iterator[str]:
         while True:
-            line = self.process.stdout.readline().strip()
-            if not line and self.process.poll() is not None:
-                break
-            lines.append(line)
+            line = self.lines.get()
+            if line is None:
+                # Engine exited; leave the marker for any later reader
+                self.lines.put(None)
+                raise RuntimeError("Engine exited")
+            yield line
             if terminator in line:
                 break
-        return lines
+
+    def receive(self, terminator: str) -> List[str]:
+        return list(self.stream(terminator))
+
+    def multipv(self, fen: str) -> List[Tuple[str, int]]:
+        self.position(fen, flush=False)
+        self.send(f"go depth {DEPTH}")
+        analysis = [None] * MULTIPV
+        prefix = f"info depth {DEPTH} "
+        for line in self.stream("bestmove"):
+            if not line.startswith(prefix):
+                continue
+            match = INFO.match(line)
+            if not match or match["bound"]:
+                continue
+            alt = int(match["multipv"])
+            score = int(match["score"])
+            if match["type"] == "mate":
+                score = (30001 if score > 0 else -30000) - 2 * score
+            if 0 < alt <= MULTIPV:
+                analysis[alt - 1] = (match["move"], score)
+        return [entry for entry in reversed(analysis) if entry]
 
     def get_fen(self, command: str = "position startpos") -> str:
-        self.send(command)
+        self.send(command, flush=False)
         self.send("d")
-        lines = self.receive("Sfen:")
-        for line in lines:
-            if line.startswith("Fen:"):
-                return line.split("Fen:", 1)[1].strip()
-        return ""
+        return self.read_fens(1)[0]
+
+    def get_fens(self, fen: str, moves: List[str]) -> List[str]:
+        for move in moves:
+            self.position(fen, (move,), flush=False)
+            self.send("d", flush=False)
+        self.flush()
+        return self.read_fens(len(moves))
+
+    def read_fens(self, count: int) -> List[str]:
+        fens = []
+        for _ in range(count):
+            fen = ""
+            for line in self.stream("Sfen:"):
+                if line.startswith("Fen:"):
+                    fen = line.split("Fen:", 1)[1].strip()
+            fens.append(fen)
+        return fens
     
     def quit(self):
         if self.process.poll() is None:
@@ -70,154 +199,486 @@ class Engine:
             self.process.wait()
 
 class Tree:
-    def __init__(self):
+    def __init__(self, read_only: bool = False):
+        # A read-only tree starts no engines and leaves the files alone, so
+        # it can be loaded next to a running explorer
         Path(VARIANT).mkdir(exist_ok=True)
-        self.engine = Engine()
+        workers = 0 if read_only else WORKERS
+        self.engines = [Engine(max(1, THREADS // WORKERS), max(1, HASH // WORKERS)) for _ in range(workers)]
+        self.pool = ThreadPoolExecutor(max_workers=WORKERS)
+        self.running = {}
+        self.last_leaf = {}
         self.fen = []
         self.move = []
-        self.score = []
-        self.best = []
-        self.children = []
-        self.length = []
-        self.fen_to_index = {}
-        self.last_saved = time.time()
-        self.data_path = Path(f"{VARIANT}/{VARIANT}_{DEPTH}.txt")
+        self.score = array('i')
+        self.best = array('i')
+        # Children are stored flat: node idx owns
+        # child_values[child_start[idx]:child_start[idx] + child_count[idx]]
+        self.child_start = array('i')
+        self.child_count = array('i')
+        self.child_values = array('i')
+        self.length = array('i')
+        self.priority = array('i')
+        self.key = array('Q')
+        self.key_to_index = {}
+        self.board = variant_board()
+        self.data_path = Path(f"{VARIANT}/{VARIANT}_{DEPTH}.bin")
+        # Text copy for tree_viewer.html, rewritten with every snapshot
+        self.text_path = Path(f"{VARIANT}/{VARIANT}_{DEPTH}.txt")
+        self.journal_path = Path(f"{VARIANT}/{VARIANT}_{DEPTH}.journal")
+        # The journal being folded into a snapshot that is still being written
+        self.prev_path = self.journal_path.with_suffix('.prev')
+        self.saver = None
         self.load_data()
+        if read_only:
+            return
+        self.analyzed = {idx for idx, count in enumerate(self.child_count) if count}
+        self.pv = self.walk([0])
+        self.pv_depth = {idx: depth for depth, idx in enumerate(self.pv)}
+        self.saved_size = len(self.fen)
+        self.journal = open(self.journal_path, 'ab', buffering=1 << 20)
+        self.journal_queue = queue.Queue()
+        threading.Thread(target=self.journal_writer, daemon=True).start()
+        if self.journal.tell() > len(MAGIC) or self.prev_path.exists():
+            self.save_data()
+        elif self.journal.tell() == 0:
+            self.journal.write(MAGIC)
         
     def load_data(self):
-        if not self.data_path.exists():
-            root_fen = self.engine.get_fen()
-            self.fen.append(root_fen)
-            self.move.append(None)
-            self.score.append(0)
-            self.best.append(None)
-            self.children.append([])
-            self.length.append(0)
-            self.fen_to_index[root_fen] = 0
+        snapshot, *journals = self.open_files()
+        if snapshot is None:
+            if not self.engines:
+                for f in journals:
+                    if f:
+                        f.close()
+                raise FileNotFoundError(f"No tree at {self.data_path}")
+            root_fen = self.engines[0].get_fen()
+            self.set_position(0, root_fen, None, 0, -1, (), 0)
+        else:
+            self.load_file(snapshot)
+        for f in journals:
+            if f:
+                self.load_file(f)
+
+    def open_files(self) -> List[Optional[io.BufferedReader]]:
+        # A running explorer may rotate its journal and replace the snapshot
+        # while --export reads them. Open everything before reading, the live
+        # journal before .prev so a rotation in between repeats records
+        # rather than losing them, and start over if the snapshot changed.
+        while True:
+            path = self.data_path if self.data_path.exists() else self.text_path
+            files = []
+            for name in (path, self.journal_path, self.prev_path):
+                try:
+                    files.append(open(name, 'rb'))
+                except FileNotFoundError:
+                    files.append(None)
+            snapshot, journal, prev = files
+            current = self.data_path if self.data_path.exists() else self.text_path
+            if snapshot is None or current == path and os.stat(path).st_ino == os.fstat(snapshot.fileno()).st_ino:
+                return [snapshot, prev, journal]
+            for f in files:
+                if f:
+                    f.close()
+
+    def load_file(self, f: io.BufferedReader):
+        with f:
+            magic = f.read(len(MAGIC))
+            if magic == SNAPSHOT:
+                self.load_columns(f)
+            elif magic == MAGIC:
+                self.load_binary(f)
+            else:
+                f.seek(0)
+                for line in io.TextIOWrapper(f):
+                    self.load_record(line)
+
+    def load_columns(self, f):
+        count, child_total, fen_size, move_size, zobrist = HEADER.unpack(f.read(HEADER.size))
+        for column, size in ((self.score, count), (self.best, count), (self.length, count),
+                             (self.child_count, count), (self.child_values, child_total), (self.key, count)):
+            column.fromfile(f, size)
+        self.fen = [sys.intern(fen) for fen in f.read(fen_size).decode().split('\n')]
+        self.move = [sys.intern(move) if move else None for move in f.read(move_size).decode().split('\n')]
+        self.child_start = array('i', accumulate(self.child_count, initial=0))
+        self.child_start.pop()
+        self.priority = array('i', map(challenger, self.score, self.length))
+        if zobrist != zobrist_keys():
+            self.key = array('Q', map(position_key, self.fen))
+        self.key_to_index = dict(zip(self.key, range(count)))
+
+    def load_binary(self, f):
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = len(MAGIC)
+            while offset + RECORD.size <= len(data):
+                idx, score, best, length, fen_len, move_len, count = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                if offset + fen_len + move_len + 4 * count > len(data):
+                    # Torn record at the end of a journal
+                    break
+                fen = data[offset:offset + fen_len].decode()
+                offset += fen_len
+                move = data[offset:offset + move_len].decode() or None
+                offset += move_len
+                children = struct.unpack_from(f'<{count}i', data, offset)
+                offset += 4 * count
+                self.set_position(idx, fen, move, score, best, children, length)
+
+    def load_record(self, line: str):
+        line = line.strip()
+        if not line or line.startswith('%'):
+            return
+        parts = line.rstrip(';').split(';')
+        if len(parts) < 2:
+            return
+        header = parts[0].strip().split('|')
+        idx = int(header[0])
+        move = header[1] if header[1] != 'None' else None
+        score_val = int(header[2])
+        best_idx = int(header[3]) if header[3] != 'None' else -1
+        length_val = int(header[4])
+        fen_str = parts[1].strip()
+        children_list = ()
+        if len(parts) > 2 and parts[2].strip():
+            children_list = tuple(int(x) for x in parts[2].strip().split(','))
+        self.set_position(idx, fen_str, move, score_val, best_idx, children_list, length_val)
+
+    def set_position(self, idx: int, fen: str, move: Optional[str], score: int,
+                     best: int, children: Tuple[int, ...], length: int):
+        fen = sys.intern(fen)
+        move = sys.intern(move) if move else None
+        if idx == len(self.fen):
+            self.fen.append(fen)
+            self.move.append(move)
+            self.score.append(score)
+            self.best.append(best)
+            self.child_start.append(0)
+            self.child_count.append(0)
+            self.length.append(length)
+            self.priority.append(challenger(score, length))
+            self.key.append(0)
+        else:
+            self.fen[idx] = fen
+            self.move[idx] = move
+            self.score[idx] = score
+            self.best[idx] = best
+            self.length[idx] = length
+            self.priority[idx] = challenger(score, length)
+        self.set_children(idx, children)
+        self.key[idx] = position_key(fen)
+        self.key_to_index[self.key[idx]] = idx
+
+    def set_children(self, idx: int, children: Iterable[int]):
+        if self.children(idx).tolist() == list(children):
             return
-            
-        with open(self.data_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('%'):
-                    continue
-                parts = line.rstrip(';').split(';')
-                if len(parts) < 2:
-                    continue
-                header = parts[0].strip().split('|')
-                idx = int(header[0])
-                move = header[1] if header[1] != 'None' else None
-                score_val = int(header[2])
-                best_idx = int(header[3]) if header[3] != 'None' else None
-                length_val = int(header[4])
-                fen_str = parts[1].strip()
-                children_list = []
-                if len(parts) > 2 and parts[2].strip():
-                    children_list = [int(x) for x in parts[2].strip().split(',')]
-                self.fen.append(fen_str)
-                self.move.append(move)
-                self.score.append(score_val)
-                self.best.append(best_idx)
-                self.children.append(children_list)
-                self.length.append(length_val)
-                self.fen_to_index[fen_str] = idx
+        self.child_start[idx] = len(self.child_values)
+        self.child_values.extend(children)
+        self.child_count[idx] = len(self.child_values) - self.child_start[idx]
+
+    def children(self, idx: int) -> array:
+        start = self.child_start[idx]
+        return self.child_values[start:start + self.child_count[idx]]
+
+    def pack_record(self, idx: int) -> bytes:
+        fen = self.fen[idx].encode()
+        move = (self.move[idx] or '').encode()
+        children = self.children(idx)
+        header = RECORD.pack(idx, self.score[idx], self.best[idx], self.length[idx],
+                             len(fen), len(move), len(children))
+        return header + fen + move + struct.pack(f'<{len(children)}i', *children)
+
+    def export(self, path: str):
+        write_text(Path(path), self.fen, self.move, self.score, self.best, self.length,
+                   self.child_start, self.child_count, self.child_values)
+        print(f"Exported {len(self.fen)} positions to {path}")
 
     def save_data(self):
-        lines = []
-        lines.append("% idx|move|score|best|length; fen; children;")
-        for idx in range(len(self.fen)):
-            move = self.move[idx] if self.move[idx] else 'None'
-            header = f"{idx}|{move}|{self.score[idx]}|{self.best[idx]}|{self.length[idx]}"
-            children_str = ','.join(map(str, self.children[idx])) if self.children[idx] else ''
-            lines.append(f"{header}; {self.fen[idx]}; {children_str};")
-        with open(self.data_path, 'w') as f:
-            f.write('\n'.join(lines) + '\n')
-        self.last_saved = time.time()
-        print(f"Saved {len(self.fen)} positions")
-
-    def analyze(self):
-        leaf = 0
-        path = [0]
-        variation = []
-        while self.best[leaf] is not None:
+        if self.saver:
+            self.saver.join()
+        self.journal_queue.join()
+        # Start a fresh journal for the changes made while the snapshot is
+        # written. If an earlier snapshot failed, keep appending instead so
+        # no record is dropped before a snapshot covers it.
+        if not self.prev_path.exists():
+            self.journal.close()
+            os.replace(self.journal_path, self.prev_path)
+            self.journal = open(self.journal_path, 'ab', buffering=1 << 20)
+            self.journal.write(MAGIC)
+            self.journal.flush()
+        columns = (self.score, self.best, self.length, self.child_start, self.child_count, self.child_values, self.key)
+        self.saver = threading.Thread(target=self.write_snapshot,
+                                      args=(list(self.fen), list(self.move), *(column[:] for column in columns)))
+        self.saver.start()
+        self.saved_size = len(self.fen)
+
+    def write_snapshot(self, fens: List[str], moves: List[Optional[str]], score: array, best: array, length: array,
+                       child_start: array, child_count: array, child_values: array, key: array):
+        # Compact the children while writing them out
+        children = array('i')
+        for start, count in zip(child_start, child_count):
+            children.extend(child_values[start:start + count])
+        fen_data = '\n'.join(fens).encode()
+        move_data = '\n'.join(move or '' for move in moves).encode()
+        temp_path = self.data_path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT + HEADER.pack(len(fens), len(children), len(fen_data), len(move_data), zobrist_keys()))
+            for column in (score, best, length, child_count, children, key):
+                column.tofile(f)
+            f.write(fen_data)
+            f.write(move_data)
+        os.replace(temp_path, self.data_path)
+        self.prev_path.unlink(missing_ok=True)
+        write_text(self.text_path, fens, moves, score, best, length, child_start, child_count, child_values)
+        print(f"Saved {len(fens)} positions")
+
+    def child_positions(self, engine: Engine, fen: str, moves: List[str]) -> List[Tuple[str, int]]:
+        if self.board:
+            try:
+                board = self.board(fen)
+                positions = []
+                for move in moves:
+                    board.push_uci(move)
+                    child_fen = board.fen()
+                    key = chess.polyglot.zobrist_hash(board) if VARIANT == "chess" else position_key(child_fen)
+                    positions.append((child_fen, key))
+                    board.pop()
+                return positions
+            except ValueError:
+                pass
+        return [(child_fen, position_key(child_fen)) for child_fen in engine.get_fens(fen, moves)]
+
+    def minimax(self, idx: int) -> bool:
+        children = self.children(idx)
+        if not children:
+            return False
+        best = max(children, key=self.priority.__getitem__)
+        score = self.score[best]
+        score = -score - 1 if score < 0 else -score + 1
+        length = self.length[best] + 1
+        if best == self.best[idx] and score == self.score[idx] and length == self.length[idx]:
+            return False
+        self.best[idx] = best
+        self.score[idx] = score
+        self.length[idx] = length
+        self.priority[idx] = challenger(score, length)
+        return True
+
+    def walk(self, path: List[int]) -> List[int]:
+        leaf = path[-1]
+        seen = set(path)
+        while self.best[leaf] >= 0 and self.best[leaf] not in seen:
             leaf = self.best[leaf]
+            seen.add(leaf)
             path.append(leaf)
-            variation.append(self.move[leaf])
-        print(*variation)
-        self.engine.send(f"position fen {self.fen[leaf]}")
-        self.engine.send(f"go depth {DEPTH}")
-        lines = self.engine.receive("bestmove")
-        for line in reversed(lines):
-            if not line.startswith("info") or "multipv" not in line:
+        return path
+
+    def update_pv(self, changed: List[int]):
+        depths = [self.pv_depth[idx] for idx in changed if idx in self.pv_depth]
+        if not depths:
+            return
+        depth = min(depths)
+        for idx in self.pv[depth + 1:]:
+            del self.pv_depth[idx]
+        del self.pv[depth + 1:]
+        self.walk(self.pv)
+        for depth in range(depth + 1, len(self.pv)):
+            self.pv_depth[self.pv[depth]] = depth
+
+    def select(self, count: int) -> List[List[int]]:
+        if count <= 0:
+            return []
+        pv = self.pv
+        paths = [pv[:]] if pv[-1] not in self.analyzed else []
+        leaves = {pv[-1]}
+        for depth in range(len(pv) - 2, -1, -1):
+            if len(paths) >= count:
+                break
+            idx = pv[depth]
+            others = [alt for alt in self.children(idx) if alt != self.best[idx]]
+            if not others:
                 continue
-            parts = line.split()
-            if int(parts[parts.index("depth") + 1]) != DEPTH:
+            path = self.walk(pv[:depth + 1] + [max(others, key=self.priority.__getitem__)])
+            if path[-1] not in leaves and path[-1] not in self.analyzed:
+                leaves.add(path[-1])
+                paths.append(path)
+        if not paths:
+            # The PV and its runners-up are finished; look for a leaf
+            # anywhere else before declaring the tree done
+            paths = self.frontier(count)
+        return paths
+
+    def frontier(self, count: int) -> List[List[int]]:
+        parent = {0: -1}
+        heap = [(0, 0)]
+        leaves = []
+        while heap and len(leaves) < count:
+            _, idx = heapq.heappop(heap)
+            children = self.children(idx)
+            if not children:
+                if idx not in self.analyzed:
+                    leaves.append(idx)
                 continue
-            alt = int(parts[parts.index("multipv") + 1])
-            move = parts[parts.index("pv") + 1]
-            score = int(parts[parts.index("score") + 2])
-            if parts[parts.index("score") + 1] == "mate":
-                if score > 0:
-                    score = 30001 - 2 * score
-                else:
-                    score = -30000 - 2 * score
-            child_fen = self.engine.get_fen(f"position fen {self.fen[leaf]} moves {move}")
-            if child_fen in self.fen_to_index:
-                child_idx = self.fen_to_index[child_fen]
-            else:
+            for child in children:
+                if child not in parent:
+                    parent[child] = idx
+                    heapq.heappush(heap, (-self.priority[child], child))
+        paths = []
+        for leaf in leaves:
+            path = [leaf]
+            while parent[path[-1]] >= 0:
+                path.append(parent[path[-1]])
+            paths.append(path[::-1])
+        return paths
+
+    def search(self, engine: Engine, fen: str) -> List[Tuple[str, int, str, int]]:
+        analysis = engine.multipv(fen)
+        children = self.child_positions(engine, fen, [move for move, _ in analysis])
+        return [(move, score, child_fen, key) for (move, score), (child_fen, key) in zip(analysis, children)]
+
+    def expand(self, path: List[int], results: List[Tuple[str, int, str, int]]):
+        leaf = path[-1]
+        first_new = len(self.fen)
+        children = []
+        for move, score, child_fen, key in results:
+            child_fen = sys.intern(child_fen)
+            child_idx = self.key_to_index.get(key, -1)
+            if child_idx < 0 or not same_position(self.fen[child_idx], child_fen):
                 child_idx = len(self.fen)
-                self.fen_to_index[child_fen] = child_idx
+                self.key_to_index[key] = child_idx
                 self.fen.append(child_fen)
-                self.move.append(move)
+                self.move.append(sys.intern(move))
                 self.score.append(-score)
-                self.best.append(None)
-                self.children.append([])
+                self.best.append(-1)
+                self.child_start.append(0)
+                self.child_count.append(0)
                 self.length.append(0)
-            self.children[leaf].append(child_idx)
-            if alt == 1:
-                break
-        for idx in reversed(path):
-            champion = -30000
-            for alt in self.children[idx]:
-                score = self.score[alt]
-                length = self.length[alt]
-                challenger = -score + length * (1 if score < 0 else -1)
-                if challenger > champion:
-                    champion = challenger
-                    self.best[idx] = alt
-                    self.length[idx] = length + 1
-                    if score < 0:
-                        self.score[idx] = -score - 1
-                    else:
-                        self.score[idx] = -score + 1
+                self.priority.append(challenger(-score, 0))
+                self.key.append(key)
+            children.append(child_idx)
+        self.set_children(leaf, children)
+        changed = [*range(first_new, len(self.fen)), leaf]
+        if self.minimax(leaf):
+            for idx in reversed(path[:-1]):
+                if not self.minimax(idx):
+                    break
+                changed.append(idx)
+        self.update_pv(changed)
+        self.write_journal(changed)
         print(self.score[leaf])
         print()
 
+    def write_journal(self, changed: List[int]):
+        if changed:
+            self.journal_queue.put(b''.join(map(self.pack_record, changed)))
+
+    def journal_writer(self):
+        while True:
+            batch = [self.journal_queue.get()]
+            while True:
+                try:
+                    batch.append(self.journal_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.journal.write(b''.join(batch))
+            self.journal.flush()
+            for _ in batch:
+                self.journal_queue.task_done()
+
+    def close(self):
+        if self.saver:
+            self.saver.join()
+        self.journal_queue.join()
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal.close()
+        self.pool.shutdown()
+        for engine in self.engines:
+            engine.quit()
+
+    def dispatch(self) -> bool:
+        pv = self.pv
+        changed = []
+        if self.best[pv[-1]] >= 0:
+            # The line repeats: back it up once more so the repetition
+            # decays towards a draw and loses to the alternatives
+            repeated = self.best[pv[-1]]
+            print(*(self.move[idx] for idx in pv[1:]), f"(repeats {repeated}: {self.fen[repeated]})")
+            changed = [idx for idx in reversed(pv) if self.minimax(idx)]
+            self.update_pv(changed)
+            self.write_journal(changed)
+        busy = {engine for engine, _ in self.running.values()}
+        idle = [engine for engine in self.engines if engine not in busy]
+        if not idle:
+            return bool(changed)
+        for path in self.select(len(idle)):
+            # Prefer the engine that searched the parent last: its hash
+            # table already covers this position
+            parent = path[-2] if len(path) > 1 else -1
+            engine = next((engine for engine in idle if self.last_leaf.get(engine) == parent), idle[0])
+            idle.remove(engine)
+            self.last_leaf[engine] = path[-1]
+            # Mark the leaf as taken while it is searched so the other
+            # workers pick different leaves
+            self.analyzed.add(path[-1])
+            print(*(self.move[idx] for idx in path[1:]))
+            self.running[self.pool.submit(self.search, engine, self.fen[path[-1]])] = (engine, path)
+        return bool(changed)
+
+    def analyze(self) -> bool:
+        changed = self.dispatch()
+        if not self.running:
+            return changed
+        done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+        for future in done:
+            _, path = self.running.pop(future)
+            self.expand(path, future.result())
+        # Restart the freed engines before returning, so they are already
+        # searching while the caller saves or compacts
+        self.dispatch()
+        return True
+
+    def merge_running(self):
+        # Keep the searches that already finished rather than searching the
+        # same leaves again next run. Stop the rest instead of waiting for
+        # them to reach full depth: a stopped search may report only some
+        # of its lines, so its leaf stays unsearched on disk.
+        finished = {future for future in self.running if future.done()}
+        for future, (engine, _) in self.running.items():
+            if future not in finished:
+                engine.send("stop")
+        wait(self.running)
+        for future in finished:
+            if future.exception() is None:
+                self.expand(self.running[future][1], future.result())
+        self.running.clear()
+
     def explore(self):
         try:
-            while True:
-                self.analyze()
-                if time.time() - self.last_saved > 900:
+            while self.analyze():
+                if len(self.fen) - self.saved_size >= COMPACT:
                     self.save_data()
+            print("No unanalyzed leaves left")
         except Exception as e:
             print(f"\nError: {e}")
             import traceback
             traceback.print_exc()
         finally:
+            self.merge_running()
             self.save_data()
-            if hasattr(self, 'engine'):
-                self.engine.quit()
+            self.close()
 
 def main():
-    global VARIANT, ENGINE, THREADS, HASH, MULTIPV, DEPTH
+    global VARIANT, ENGINE, THREADS, HASH, MULTIPV, DEPTH, WORKERS
 
     parser = argparse.ArgumentParser(description='Tree Explorer')
     parser.add_argument('--variant', help=f'Variant (default: {VARIANT})')
     parser.add_argument('--engine', help=f'Engine path (default: {ENGINE})')
     parser.add_argument('--threads', type=int, help=f'Threads (default: {THREADS})')
-    parser.add_argument('--hash', type=int, help=f'Hash MB (default: {HASH})')
+    parser.add_argument('--hash', type=int, help=f'Hash MB, kept across positions so nearby leaves reuse it (default: {HASH})')
     parser.add_argument('--multipv', type=int, help=f'MultiPV (default: {MULTIPV})')
     parser.add_argument('--depth', type=int, help=f'Depth (default: {DEPTH})')
+    parser.add_argument('--workers', type=int, help=f'Engine processes sharing --threads and --hash (default: {WORKERS})')
+    parser.add_argument('--export', metavar='PATH', help='Write the saved tree as text to PATH and exit; safe while exploring')
 
     args = parser.parse_args()
     
@@ -227,9 +688,12 @@ def main():
     if args.hash: HASH = args.hash
     if args.multipv: MULTIPV = args.multipv
     if args.depth: DEPTH = args.depth
+    if args.workers: WORKERS = args.workers
 
-    tree = Tree()
-    tree.explore()
+    if args.export:
+        Tree(read_only=True).export(args.export)
+    else:
+        Tree().explore()
 
 if __name__ == '__main__':
     main()